@@ -1,17 +1,27 @@
 #!/usr/bin/env python3
-import requests
+import diskcache
+import httpx
+import imagehash
+import numpy as np
+import torch
 from argparse import ArgumentParser
-from cachetools import LRUCache, TTLCache, cached, keys
+from cachetools import LRUCache, TTLCache, cached
 from colorlog import ColoredFormatter, StreamHandler
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
+from dataclasses import dataclass
+from hashlib import sha256
 from io import BytesIO
 from logging import DEBUG, INFO, getLogger
 from mastodon import CallbackStreamListener, Mastodon
+from os import path
 from PIL import Image
+from queue import Empty, Queue
 from signal import SIGINT, SIGTERM, signal
 from sys import exit
-from time import sleep
-from transformers import pipeline
+from threading import Event, Lock, Thread
+from time import sleep, time
+from transformers import AutoImageProcessor, AutoModelForImageClassification
 
 logger = getLogger("avatar-blocker")
 logger.setLevel(INFO)
@@ -74,78 +84,293 @@ parser.add_argument(
     type=int,
     help="how long (in minutes) to cache user relationships for (default: 6 hours)"
 )
+parser.add_argument(
+    "--cache-dir",
+    "-cd",
+    type=str,
+    help="where to persist downloaded avatars and verdicts across restarts (default: avatar-cache)"
+)
 parser.add_argument(
     "--user-agent", "-ua", type=str, help="the User-Agent header to send to the Mastodon api (default: \"mastodon-autoblock-utilities/avatar-blocker/1.0\")"
 )
+parser.add_argument(
+    "--compile",
+    "-c",
+    help="compile the classification model with torch.compile for faster inference (requires torch 2.0+)",
+    action="store_true"
+)
+parser.add_argument(
+    "--cuda-graphs",
+    "-cg",
+    help=
+    "compile the classification model for a fixed batch shape so it can be replayed with CUDA graphs (requires torch 2.2+ and a CUDA GPU)",
+    action="store_true"
+)
+parser.add_argument(
+    "--quantize",
+    "-q",
+    type=str,
+    choices=["none", "int8", "bf16"],
+    help=
+    "quantize the classification model. int8 is CPU-only, bf16 needs a CPU or GPU with bfloat16 support (default: none)"
+)
+parser.add_argument(
+    "--backend",
+    "-be",
+    type=str,
+    choices=["torch", "onnx"],
+    help=
+    "what to run the classification model with. onnx exports the model for ONNX Runtime on the CPU, and requires optimum[onnxruntime] (default: torch)"
+)
 parser.add_argument("--debug", "-d", help="debug logging", action="store_true")
 args = parser.parse_args()
 
 config = ConfigParser()
 config.read("avatar.ini")
-if "config" in config:
-	config = config["config"]
-else:
+if "config" not in config:
 	logger.warn("config file not setup, I hope you have defaults set!")
-	config = {}
-
-instance = args.instance or str(config.get("instance", "mastodon.social"))
-access_token = args.access_token or str(config.get("access-token", "INVALID"))
-model = args.model or str(config.get("model", "google/vit-base-patch16-224"))
-auto_block = args.auto_block or bool(config.get("auto-block", False))
-bad_categories = (args.bad_categories or str(config.get("bad-categories", "bad"))).split(",")
-minimum_score = args.minimum_score or float(config.get("minimum-score", 0.75))
-watch_hashtags = (args.watch_hashtags or config.get("watch-hashtags", "")).split(",")
-include_following = args.include_following or bool(config.get("include-following", False))
-exclude_followers = args.exclude_followers or bool(config.get("exclude-followers", False))
-no_listen_public = args.no_listen_public or bool(config.get("no-listen-public", False))
-no_listen_user = args.no_listen_user or bool(config.get("no-listen-user", False))
-image_cache_ttl = args.image_cache_ttl or int(config.get("image-cache-ttl", 45))
-relationship_cache_ttl = args.relationship_cache_ttl or int(config.get("relationship-cache-ttl", 360))
-user_agent = args.user_agent or config.get("user-agent", "mastodon-autoblock-utilities/avatar-blocker/1.0")
-
-headers = {"User-Agent": user_agent}
+	config.add_section("config")
+config = config["config"]
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+	instance: str
+	access_token: str
+	model: str
+	auto_block: bool
+	bad_categories: tuple[str, ...]
+	minimum_score: float
+	watch_hashtags: tuple[str, ...]
+	include_following: bool
+	exclude_followers: bool
+	no_listen_public: bool
+	no_listen_user: bool
+	image_cache_ttl: int
+	relationship_cache_ttl: int
+	cache_dir: str
+	user_agent: str
+	compile_model: bool
+	cuda_graphs: bool
+	quantize: str
+	backend: str
+
+
+settings = Settings(
+    instance=args.instance or str(config.get("instance", "mastodon.social")),
+    access_token=args.access_token or str(config.get("access-token", "INVALID")),
+    model=args.model or str(config.get("model", "google/vit-base-patch16-224")),
+    auto_block=args.auto_block or config.getboolean("auto-block", fallback=False),
+    bad_categories=tuple((args.bad_categories or str(config.get("bad-categories", "bad"))).split(",")),
+    minimum_score=args.minimum_score or float(config.get("minimum-score", 0.75)),
+    watch_hashtags=tuple((args.watch_hashtags or config.get("watch-hashtags", "")).split(",")),
+    include_following=args.include_following or config.getboolean("include-following", fallback=False),
+    exclude_followers=args.exclude_followers or config.getboolean("exclude-followers", fallback=False),
+    no_listen_public=args.no_listen_public or config.getboolean("no-listen-public", fallback=False),
+    no_listen_user=args.no_listen_user or config.getboolean("no-listen-user", fallback=False),
+    image_cache_ttl=args.image_cache_ttl or int(config.get("image-cache-ttl", 45)),
+    relationship_cache_ttl=args.relationship_cache_ttl or int(config.get("relationship-cache-ttl", 360)),
+    cache_dir=args.cache_dir or str(config.get("cache-dir", "avatar-cache")),
+    user_agent=args.user_agent or config.get("user-agent", "mastodon-autoblock-utilities/avatar-blocker/1.0"),
+    compile_model=args.compile or config.getboolean("compile", fallback=False),
+    cuda_graphs=args.cuda_graphs or config.getboolean("cuda-graphs", fallback=False),
+    quantize=args.quantize or str(config.get("quantize", "none")),
+    backend=args.backend or str(config.get("backend", "torch")),
+)
+
+headers = {"User-Agent": settings.user_agent}
+
+http = httpx.Client(
+    headers=headers,
+    timeout=10.0,
+    follow_redirects=True,
+    transport=httpx.HTTPTransport(
+        http2=True, retries=2, limits=httpx.Limits(max_connections=32, max_keepalive_connections=32)
+    )
+)
+download_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="download")
+disk_cache = diskcache.Cache(settings.cache_dir, size_limit=2 << 30)
+
+PHASH_MAX_DISTANCE = 4
+PHASH_MIN_STDDEV = 16
+PHASH_TTL = 7 * 24 * 60 * 60
+PHASH_MAX_KNOWN = 65536
+# known hashes are only valid for the model and thresholds that produced them
+phash_categories = sorted(category.strip().lower() for category in settings.bad_categories)
+phash_namespace = sha256(repr((settings.model, phash_categories, settings.minimum_score)).encode()).hexdigest()[:16]
+
+MAX_BATCH = 16
+BATCH_TIMEOUT = 0.05
+WARMUP_RUNS = 3
+pending_queue = Queue()
+worker_ready = Event()
+seen_statuses = TTLCache(maxsize=4096, ttl=300)
+seen_statuses_lock = Lock()
+RELATIONSHIP_REFRESH_INTERVAL = 30 * 60
 
 if args.debug:
 	logger.setLevel(DEBUG)
 
-logger.info("Loading model '%s' from HuggingFace", model)
-classifier = pipeline("image-classification", model=model)
+logger.info("Loading model '%s' from HuggingFace", settings.model)
+processor = AutoImageProcessor.from_pretrained(settings.model)
+if settings.backend == "onnx":
+	from optimum.onnxruntime import ORTModelForImageClassification
+	onnx_path = path.join("onnx-cache", settings.model.replace("/", "--"))
+	if path.isdir(onnx_path):
+		classifier = ORTModelForImageClassification.from_pretrained(onnx_path, provider="CPUExecutionProvider")
+	else:
+		logger.info("exporting model to ONNX, this may take a while")
+		classifier = ORTModelForImageClassification.from_pretrained(
+		    settings.model, export=True, provider="CPUExecutionProvider"
+		)
+		classifier.save_pretrained(onnx_path)
+	if settings.quantize != "none":
+		logger.warning("quantization isn't supported with the ONNX backend, running model unquantized")
+	device = torch.device("cpu")
+	dtype = torch.float32
+else:
+	if settings.backend != "torch":
+		logger.warning("unknown backend '%s', using torch", settings.backend)
+	classifier = AutoModelForImageClassification.from_pretrained(settings.model).eval()
+	device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+	if settings.quantize == "int8":
+		if device.type == "cuda":
+			logger.warning("int8 quantization is CPU-only, running model on the CPU")
+			device = torch.device("cpu")
+		dtype = torch.float32
+		classifier = torch.ao.quantization.quantize_dynamic(classifier, {torch.nn.Linear}, dtype=torch.qint8)
+	elif settings.quantize == "bf16":
+		dtype = torch.bfloat16
+	else:
+		if settings.quantize != "none":
+			logger.warning("unknown quantization '%s', running model unquantized", settings.quantize)
+		dtype = torch.float16 if device.type == "cuda" else torch.float32
+	classifier = classifier.to(device, dtype=dtype)
+label2id = {label.strip().lower(): id for label, id in classifier.config.label2id.items()}
+logger.info("running model on %s (%s)", device, dtype)
+
+torch_version = tuple(int(part) for part in torch.__version__.split("+")[0].split(".")[:2])
+cuda_graphs = settings.cuda_graphs
+if cuda_graphs and device.type != "cuda":
+	logger.warning("CUDA graphs require a CUDA GPU, disabling them")
+	cuda_graphs = False
+elif cuda_graphs and torch_version < (2, 2):
+	logger.warning("CUDA graphs require torch 2.2 or newer, disabling them")
+	cuda_graphs = False
+
+bad_label_ids = []
+for category in settings.bad_categories:
+	category = category.strip().lower()
+	if category in label2id:
+		bad_label_ids.append(label2id[category])
+	else:
+		logger.warning("bad category '%s' is not a label of model '%s', ignoring it", category, settings.model)
+if not bad_label_ids:
+	logger.warning("none of the bad categories are labels of model '%s', nobody will be considered bad", settings.model)
+bad_ids = torch.tensor(bad_label_ids, dtype=torch.long, device=device)
+
+processor_size = getattr(processor, "size", None) or {}
+if (
+    "height" in processor_size and "width" in processor_size and getattr(processor, "do_resize", False)
+    and getattr(processor, "do_rescale", False) and getattr(processor, "do_normalize", False)
+    and not getattr(processor, "do_center_crop", False)
+):
+	input_size = (processor_size["width"], processor_size["height"])
+	pixel_std = np.array(processor.image_std, dtype=np.float32).reshape(1, 1, 1, 3)
+	pixel_scale = processor.rescale_factor / pixel_std
+	pixel_offset = np.array(processor.image_mean, dtype=np.float32).reshape(1, 1, 1, 3) / pixel_std
+else:
+	logger.info("model '%s' needs more than a resize and normalize, using its image processor", settings.model)
+	input_size = None
+
+
+def preprocess_pfps(pfps):
+	if input_size is None:
+		return processor(pfps, return_tensors="pt")["pixel_values"]
+	batch = np.stack(
+	    [np.asarray(pfp if pfp.size == input_size else pfp.resize(input_size, processor.resample)) for pfp in pfps]
+	)
+	# rescale and normalize in one pass: (x * rescale - mean) / std
+	batch = batch.astype(np.float32) * pixel_scale - pixel_offset
+	return torch.from_numpy(np.ascontiguousarray(batch.transpose(0, 3, 1, 2)))
+
+
+def classify_pfps(pfps):
+	pixel_values = preprocess_pfps(pfps)
+	count = pixel_values.shape[0]
+	if cuda_graphs and count < MAX_BATCH:
+		# pad up to the captured batch shape, the padding rows are dropped below
+		padding = pixel_values.new_zeros((MAX_BATCH - count, *pixel_values.shape[1:]))
+		pixel_values = torch.cat([pixel_values, padding])
+	if device.type == "cuda":
+		pixel_values = pixel_values.pin_memory()
+	pixel_values = pixel_values.to(device, dtype=dtype, non_blocking=True)
+	with torch.inference_mode(), torch.autocast(device.type, dtype=dtype, enabled=dtype == torch.bfloat16):
+		logits = classifier(pixel_values=pixel_values).logits
+		return logits[:count].float().softmax(-1)
 
 
-def cache_key_acct(*args, **kwargs):
-	global logger
-	if len(args) != 1:
-		logger.warn("encountered an invalid account function while caching: args=%s", args)
-		return keys.hashkey(*args, **kwargs)
-	account = args[0]
-	if not "id" in account:
-		logger.warn("encountered an invalid account while caching: account=%s", account)
-		return keys.hashkey(*args, **kwargs)
-	return hash(account["id"])
+compiled = False
+if settings.compile_model or cuda_graphs:
+	if settings.backend == "onnx":
+		logger.warning("torch.compile doesn't apply to the ONNX backend, running model uncompiled")
+	elif hasattr(torch, "compile"):
+		classifier = torch.compile(
+		    classifier, mode="reduce-overhead", fullgraph=False, dynamic=False if cuda_graphs else None
+		)
+		compiled = True
+	else:
+		logger.warning("torch.compile requires torch 2.0 or newer, running model uncompiled")
+
+
+def cache_key_acct(account):
+	return account["id"]
+
+
+def disk_cache_key(kind, account):
+	url_hash = sha256(account.get("avatar_static", "").encode()).hexdigest()[:16]
+	return (kind, account["id"], url_hash)
+
+
+def cache_key_pfp(account):
+	return disk_cache_key("pfp", account)
 
 
-@cached(cache=TTLCache(maxsize=1024, ttl=image_cache_ttl * 60), key=cache_key_acct)
+@cached(cache=TTLCache(maxsize=1024, ttl=settings.image_cache_ttl * 60), key=cache_key_pfp, lock=Lock())
 def download_pfp(account):
-	global logger, headers
 	if "avatar_static" not in account:
 		return None
 	name = account["acct"]
 	pfp_url = account["avatar_static"]
-	response = requests.get(pfp_url, headers=headers, timeout=10)
-	if response.ok:
+	key = disk_cache_key("pfp", account)
+	content = disk_cache.get(key)
+	if content is None:
 		try:
-			return Image.open(BytesIO(response.content)).convert("RGB").resize((224, 224))
+			response = http.get(pfp_url)
 		except:
-			logger.exception("failed to get avatar for %s", name)
+			logger.exception("failed to download avatar for %s", name)
 			return None
-	else:
-		logger.error("failed to download avatar for %s: http code %i", name, response.status_code)
+		if not response.is_success:
+			logger.error("failed to download avatar for %s: http code %i", name, response.status_code)
+			return None
+		content = response.content
+		disk_cache.set(key, content, expire=settings.image_cache_ttl * 60)
+	try:
+		pfp = Image.open(BytesIO(content))
+		if input_size is None:
+			return pfp.convert("RGB")
+		# JPEGs at least twice the input size get decoded at 1/2, 1/4 or 1/8 scale. this is a no-op for anything
+		# smaller (like mastodon's usual 400x400 avatars) and for other formats
+		pfp.draft("RGB", input_size)
+		# only keep what the model needs in the cache, full size avatars add up quickly
+		return pfp.convert("RGB").resize(input_size, processor.resample)
+	except:
+		logger.exception("failed to get avatar for %s", name)
 		return None
 
 
-@cached(cache=TTLCache(maxsize=1024, ttl=relationship_cache_ttl * 60), key=cache_key_acct)
+@cached(cache=TTLCache(maxsize=1024, ttl=settings.relationship_cache_ttl * 60), key=cache_key_acct)
 def get_relationship(account):
-	global logger, mastodon
 	id = account["id"]
 	name = account["acct"]
 	try:
@@ -155,73 +380,257 @@ def get_relationship(account):
 		return
 
 
-@cached(cache=LRUCache(maxsize=512), key=cache_key_acct)
-def is_account_bad(account):
-	global logger, classifier, bad_categories, minimum_score
+verdict_cache = LRUCache(maxsize=512)
+
+
+def get_classifiable_pfp(account):
 	if not "avatar_static" in account:
-		return False
+		return None
 	user = account["acct"]
 	if account["avatar_static"].endswith("/missing.png"):
 		logger.debug("user @%s has default pfp, skipping", user)
-		return
+		return None
 	logger.debug("checking user %s", user)
-	pfp = download_pfp(account)
-	if not pfp:
-		return False
+	return download_pfp(account)
+
+
+def load_known_hashes():
+	known = {verdict: ([], []) for verdict in (True, False)}
+	for key in disk_cache.iterkeys():
+		if not isinstance(key, tuple) or len(key) != 4 or key[0] != "phash" or key[1] != phash_namespace:
+			continue
+		expires = disk_cache.get(key)
+		if expires is None:
+			continue
+		known[key[2]][0].append(key[3])
+		known[key[2]][1].append(expires)
+	loaded = {}
+	for verdict, (hashes, expires) in known.items():
+		order = np.argsort(expires)[-PHASH_MAX_KNOWN:]
+		loaded[verdict] = (np.array(hashes, dtype=np.uint64)[order], np.array(expires, dtype=np.float64)[order])
+	return loaded
+
+
+known_hashes = load_known_hashes()
+
+
+def perceptual_hash(pfp):
+	# flat avatars (solid colours, simple logos) all hash alike, so they'd match each other
+	if np.asarray(pfp.convert("L").resize((32, 32))).std() < PHASH_MIN_STDDEV:
+		return None
+	return int(str(imagehash.phash(pfp)), 16)
+
+
+def match_known_hash(pfp_hash):
+	now = time()
+	for verdict in (True, False):
+		known, expires = known_hashes[verdict]
+		if known.size == 0:
+			continue
+		distances = np.unpackbits((known ^ np.uint64(pfp_hash)).view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+		if ((distances <= PHASH_MAX_DISTANCE) & (expires > now)).any():
+			return verdict
+	return None
+
+
+def save_known_hashes(new_hashes):
+	now = time()
+	for verdict in (True, False):
+		hashes = [pfp_hash for pfp_hash, hash_verdict in new_hashes if hash_verdict == verdict]
+		if not hashes:
+			continue
+		for pfp_hash in hashes:
+			disk_cache.set(("phash", phash_namespace, verdict, pfp_hash), now + PHASH_TTL, expire=PHASH_TTL)
+		known, expires = known_hashes[verdict]
+		live = expires > now
+		known = np.append(known[live], np.array(hashes, dtype=np.uint64))[-PHASH_MAX_KNOWN:]
+		expires = np.append(expires[live], np.full(len(hashes), now + PHASH_TTL))[-PHASH_MAX_KNOWN:]
+		known_hashes[verdict] = (known, expires)
+
+
+def save_verdict(account, verdict):
+	key = disk_cache_key("verdict", account)
+	verdict_cache[key] = verdict
+	disk_cache.set(key, verdict, expire=settings.image_cache_ttl * 60)
+
+
+def are_accounts_bad(accounts, *, _bad_ids=bad_ids, _min_score=settings.minimum_score):
+	verdicts = [False] * len(accounts)
+	uncached = []
+	for idx, account in enumerate(accounts):
+		key = disk_cache_key("verdict", account)
+		if key in verdict_cache:
+			verdicts[idx] = verdict_cache[key]
+			continue
+		verdict = disk_cache.get(key)
+		if verdict is not None:
+			verdict_cache[key] = verdict
+			verdicts[idx] = verdict
+		else:
+			uncached.append((idx, account, key))
+	pfps = download_executor.map(get_classifiable_pfp, [account for _, account, _ in uncached])
+	pending = []
+	for (idx, account, key), pfp in zip(uncached, pfps):
+		if not pfp:
+			verdict_cache[key] = False
+			continue
+		pfp_hash = perceptual_hash(pfp)
+		verdict = match_known_hash(pfp_hash) if pfp_hash is not None else None
+		if verdict is not None:
+			logger.debug("avatar of %s matches a known %s avatar", account["acct"], "bad" if verdict else "good")
+			save_verdict(account, verdict)
+			verdicts[idx] = verdict
+			continue
+		pending.append((idx, account, pfp, pfp_hash))
+	if not pending or _bad_ids.numel() == 0:
+		return verdicts
 	try:
-		classification = classifier(pfp)
-		logger.debug("classification of %s: %s", user, classification)
-		for cls in classification:
-			if not "score" in cls or not "label" in cls:
-				continue
-			score = cls["score"]
-			label = cls["label"]
-			if score < minimum_score:
-				continue
-			if label in bad_categories:
-				return True
+		probs = classify_pfps([pfp for _, _, pfp, _ in pending])
+		bad_scores = probs[:, _bad_ids].max(dim=1).values.cpu().tolist()
 	except:
-		logger.exception("failed to classify pfp of %s", user)
-	return False
+		logger.exception("failed to classify pfps of %s", ", ".join(account["acct"] for _, account, _, _ in pending))
+		return verdicts
+	new_hashes = []
+	for (idx, account, _, pfp_hash), bad_score in zip(pending, bad_scores):
+		logger.debug("highest bad score of %s: %f", account["acct"], bad_score)
+		verdict = bad_score >= _min_score
+		save_verdict(account, verdict)
+		if pfp_hash is not None:
+			new_hashes.append((pfp_hash, verdict))
+		verdicts[idx] = verdict
+	save_known_hashes(new_hashes)
+	return verdicts
+
+
+# note that refreshing pages through every follow on the same client (and rate limit budget) that blocks go through,
+# so on very large accounts a refresh can use up the budget and, in mastodon.py's default "wait" mode, delay blocks
+class RelationshipSnapshot:
+
+	def __init__(self, fetch_following, fetch_followers):
+		self.fetch_following = fetch_following
+		self.fetch_followers = fetch_followers
+		self.following = set()
+		self.followers = set()
+		self.ready = False
+
+	def fetch_ids(self, page):
+		return {account["id"] for account in mastodon.fetch_remaining(page)}
+
+	def refresh(self):
+		following = set()
+		followers = set()
+		try:
+			if self.fetch_following:
+				following = self.fetch_ids(mastodon.account_following(me["id"], limit=80))
+			if self.fetch_followers:
+				followers = self.fetch_ids(mastodon.account_followers(me["id"], limit=80))
+		except:
+			logger.exception("failed to refresh relationships")
+			return
+		self.following = following
+		self.followers = followers
+		self.ready = True
+		logger.info("loaded relationships: following %i, followed by %i", len(following), len(followers))
+
+	def run(self):
+		while True:
+			self.refresh()
+			sleep(RELATIONSHIP_REFRESH_INTERVAL)
+
+
+def handle_bad_account(
+    account,
+    *,
+    _auto_block=settings.auto_block,
+    _include_following=settings.include_following,
+    _exclude_followers=settings.exclude_followers
+):
+	id = account["id"]
+	name = account["acct"]
+	following = id in relationship_snapshot.following
+	followed_by = id in relationship_snapshot.followers
+	# the snapshot isn't loaded yet, or can be up to RELATIONSHIP_REFRESH_INTERVAL old (new followers are added from
+	# notifications, new follows aren't), so only ask the api on a miss when we're about to block someone
+	no_pass = (not _include_following and not following) or (_exclude_followers and not followed_by)
+	if no_pass and (_auto_block or not relationship_snapshot.ready):
+		relationships = get_relationship(account) or {}
+		if isinstance(relationships, list):
+			if len(relationships) > 0:
+				relationships = relationships[0]
+			else:
+				relationships = {}
+		following = following or relationships.get("following", False)
+		followed_by = followed_by or relationships.get("followed_by", False)
+	if not _include_following and following:
+		logger.info("%s would be bad, but we're following them, so they get a pass", name)
+		return
+	if _exclude_followers and followed_by:
+		logger.info("%s would be bad, but they're following us, so they get a pass", name)
+		return
+	logger.info("oh no, %s is bad!", name)
+	if _auto_block:
+		logger.info("blocking %s", name)
+		try:
+			mastodon.account_block(id)
+		except:
+			logger.exception("failed to block %s", name)
+
+
+def warm_up_classifier():
+	logger.info("compiling model, this may take a while")
+	try:
+		for _ in range(WARMUP_RUNS):
+			classify_pfps([Image.new("RGB", (224, 224))])
+	except:
+		logger.exception("failed to warm up compiled model")
+
+
+def classify_worker():
+	# cudagraph trees are per-thread, so the compiled model has to be warmed up (and captured) on this thread
+	if compiled:
+		warm_up_classifier()
+	worker_ready.set()
+	while True:
+		batch = [pending_queue.get()]
+		while len(batch) < MAX_BATCH:
+			try:
+				batch.append(pending_queue.get(timeout=BATCH_TIMEOUT))
+			except Empty:
+				break
+		batch = list({account["id"]: account for account in batch}.values())
+		try:
+			verdicts = are_accounts_bad(batch)
+		except:
+			logger.exception("failed to check batch of %i accounts", len(batch))
+			continue
+		for account, bad in zip(batch, verdicts):
+			if bad:
+				handle_bad_account(account)
+
+
+def on_notification(notification):
+	if notification.get("type") == "follow" and "account" in notification:
+		relationship_snapshot.followers.add(notification["account"]["id"])
 
 
 def on_stream(data):
-	global logger, mastodon, auto_block
+	if "id" in data:
+		with seen_statuses_lock:
+			if data["id"] in seen_statuses:
+				return
+			seen_statuses[data["id"]] = True
 	if "account" in data:
 		account = data["account"]
-		if "id" not in account:
+		if account.get("id") is None or account["id"] == me["id"]:
 			return
-		if is_account_bad(account):
-			id = account["id"]
-			name = account["acct"]
-			relationships = get_relationship(account) or {}
-			if isinstance(relationships, list):
-				if len(relationships) > 0:
-					relationships = relationships[0]
-				else:
-					relationships = {}
-			if not include_following and relationships.get("following", False):
-				logger.info("%s would be bad, but we're following them, so they get a pass", name)
-				return
-			if exclude_followers and relationships.get("followed_by", False):
-				logger.info("%s would be bad, but they're following us, so they get a pass", name)
-				return
-			logger.info("oh no, %s is bad!", name)
-			if auto_block:
-				logger.info("blocking %s", name)
-				try:
-					mastodon.account_block(id)
-				except:
-					logger.exception("failed to block %s", name)
+		pending_queue.put(account)
 
 
 def signal_handler(sig, frame):
-	global logger
 	logger.warning("Ctrl+C pressed, exiting")
 	exit(0)
 
 def check_hashtag_timeline(hashtag):
-	global mastodon, logger
 	logger.info("Checking timeline of #%s", hashtag)
 	try:
 		timeline = mastodon.timeline_hashtag(hashtag)
@@ -232,21 +641,31 @@ def check_hashtag_timeline(hashtag):
 		 on_stream(status)
 
 try:
-	mastodon = Mastodon(access_token=access_token, api_base_url=f"https://{instance}")
+	mastodon = Mastodon(access_token=settings.access_token, api_base_url=f"https://{settings.instance}")
 	me = mastodon.me()
 except:
 	logger.exception("failed to log into mastodon")
 logger.info("logged into Mastodon as @%s", me.acct)
 
-if not no_listen_user:
-	mastodon.stream_user(CallbackStreamListener(update_handler=on_stream), run_async=True, reconnect_async=True)
+relationship_snapshot = RelationshipSnapshot(not settings.include_following, settings.exclude_followers)
+Thread(target=relationship_snapshot.run, name="relationship-refresh", daemon=True).start()
+
+Thread(target=classify_worker, name="classify-worker", daemon=True).start()
+worker_ready.wait()
+
+if not settings.no_listen_user:
+	mastodon.stream_user(
+	    CallbackStreamListener(update_handler=on_stream, notification_handler=on_notification),
+	    run_async=True,
+	    reconnect_async=True
+	)
 	logger.info("listening to user stream")
 
-if not no_listen_public:
+if not settings.no_listen_public:
 	mastodon.stream_public(CallbackStreamListener(update_handler=on_stream), run_async=True, reconnect_async=True)
 	logger.info("listening to public stream")
 
-for hashtag in watch_hashtags:
+for hashtag in settings.watch_hashtags:
 	hashtag = hashtag.removeprefix("#").strip()
 	mastodon.stream_hashtag(
 	    hashtag, CallbackStreamListener(update_handler=on_stream), run_async=True, reconnect_async=True